@@ -12,7 +12,6 @@ of the BSD license. See the LICENSE file for details.
 # If changes are necessary, edit ./rel-eng/version_init.template
 #
 
-from __future__ import absolute_import
 from .parser import DockerfileParser  # noqa: F401
 
 __version__ = "2.0.1"
@@ -13,6 +13,7 @@ import os
 import re
 from contextlib import contextmanager
 from shlex import quote
+from sys import intern
 
 from .constants import DOCKERFILE_FILENAME, COMMENT_INSTRUCTION
 from .util import (b2u, extract_key_values, get_key_val_dictionary,
@@ -21,6 +22,28 @@ from .util import (b2u, extract_key_values, get_key_val_dictionary,
 
 logger = logging.getLogger(__name__)
 
+# instructions with a set of key value pairs as value
+_KEY_VALUE_INSTRUCTIONS = frozenset(('ARG', 'ENV', 'LABEL'))
+
+_IMAGE_FROM_RE = re.compile(r"""(?xi)   # readable, case-insensitive regex
+    \s*                                 # ignore leading whitespace
+    (?P<platform> --platform=\S+)?      # optional platform parameter
+    \s*                                 # more whitespaces
+    (?P<image> \S+ )                    # image and optional tag
+    (?:                                 # optional "AS name" clause for stage
+        \s+ AS \s+
+        (?P<name> \S+ )
+    )?
+    """)
+
+# regexes used for splitting the Dockerfile into instructions
+_INSTRUCTION_RE = re.compile(r'^\s*(\S+)\s+(.*)$')  # matched group is insn
+_COMMENT_RE = re.compile(r'^\s*#')                  # line is a comment?
+# escape directive regex
+_ESCAPE_DIRECTIVE_RE = re.compile(r'^\s*#\s*escape\s*=\s*(\\|`)\s*$', re.I)
+# syntax directive regex
+_SYNTAX_DIRECTIVE_RE = re.compile(r'^\s*#\s*syntax\s*=\s*(.*)\s*$', re.I)
+
 
 class KeyValues(dict):
     """
@@ -116,6 +139,17 @@ class DockerfileParser(object):
         self.cache_content = cache_content
         self.cached_content = ''  # unicode string
 
+        # lines kept in memory by edit() until they are flushed
+        self._deferred = False
+        self._pending_lines = None
+
+        # (inputs, result) of the last line splitting, structure and context_structure computations
+        self._lines_cache = None
+        self._structure_cache = None
+        self._context_structure_cache = None
+        # instruction name -> (inputs, result) of the last _instruction_getter() call
+        self._instruction_cache = {}
+
         if cache_content:
             try:
                 # this will cache the Dockerfile content
@@ -152,20 +186,61 @@ class DockerfileParser(object):
             with open(self.dockerfile_path, mode) as dockerfile:
                 yield dockerfile
 
+    @contextmanager
+    def edit(self):
+        """
+        Batch modifications of the Dockerfile, e.g.:
+
+        with parser.edit():
+            parser.labels = {'name': 'value'}
+            parser.add_lines('RUN true')
+
+        While in the context, changes are kept in memory and the Dockerfile
+        is written only once, on exit. If the context exits with an exception,
+        the changes not written yet are discarded and the Dockerfile is left
+        as it was. Nested calls are no-ops.
+        """
+        if self._deferred:
+            yield self
+            return
+
+        self._deferred = True
+        try:
+            yield self
+        except BaseException:
+            self._pending_lines = None
+            raise
+        finally:
+            self._deferred = False
+        self.flush()
+
+    def flush(self):
+        """
+        Write changes held back by edit() to the Dockerfile
+        """
+        if self._pending_lines is None:
+            return
+
+        lines, self._pending_lines = self._pending_lines, None
+        self._write_lines(lines)
+
     @property
     def lines(self):
         """
         :return: list containing lines (unicode) from Dockerfile
         """
+        if self._pending_lines is not None:
+            return list(self._pending_lines)
+
         if self.cache_content and self.cached_content:
-            return self.cached_content.splitlines(True)
+            return list(self._split_content(self.cached_content))
 
         try:
             with self._open_dockerfile('rb') as dockerfile:
-                lines = [b2u(line) for line in dockerfile.readlines()]
+                content = b2u(dockerfile.read())
                 if self.cache_content:
-                    self.cached_content = ''.join(lines)
-                return lines
+                    self.cached_content = content
+                return list(self._split_content(content))
         except (IOError, OSError) as ex:
             logger.error("Couldn't retrieve lines from dockerfile: %r", ex)
             raise
@@ -176,21 +251,42 @@ class DockerfileParser(object):
         Fill Dockerfile content with specified lines
         :param lines: list of lines to be written to Dockerfile
         """
+        if self._deferred:
+            self._pending_lines = _split_lines(''.join(b2u(line) for line in lines))
+            return
+
+        self._write_lines(lines)
+
+    def _write_lines(self, lines):
+        content = ''.join(b2u(line) for line in lines)
         if self.cache_content:
-            self.cached_content = ''.join(b2u(line) for line in lines)
+            self.cached_content = content
 
         try:
             with self._open_dockerfile('wb') as dockerfile:
-                dockerfile.writelines(u2b(line) for line in lines)
+                dockerfile.write(u2b(content))
         except (IOError, OSError) as ex:
             logger.error("Couldn't write lines to dockerfile: %r", ex)
             raise
 
+    def _split_content(self, content):
+        """
+        :param content: string (unicode) with Dockerfile content
+        :return: list of lines of content, shared until the content changes, so it should not
+            be modified
+        """
+        if self._lines_cache is None or self._lines_cache[0] != content:
+            self._lines_cache = (content, _split_lines(content))
+        return self._lines_cache[1]
+
     @property
     def content(self):
         """
         :return: string (unicode) with Dockerfile content
         """
+        if self._pending_lines is not None:
+            return ''.join(self._pending_lines)
+
         if self.cache_content and self.cached_content:
             return self.cached_content
 
@@ -210,6 +306,10 @@ class DockerfileParser(object):
         Overwrite Dockerfile with specified content
         :param content: string to be written to Dockerfile
         """
+        if self._deferred:
+            self._pending_lines = _split_lines(b2u(content))
+            return
+
         if self.cache_content:
             self.cached_content = b2u(content)
 
@@ -238,6 +338,18 @@ class DockerfileParser(object):
              "value": "yum -y update && yum clean all"}
         ]
         """
+        # callers may modify the dicts, keep them away from the cached ones
+        return [dict(instruction) for instruction in self._structure_for(self.content)]
+
+    def _structure_for(self, content):
+        """
+        :param content: string (unicode) with Dockerfile content
+        :return: list of dicts describing the commands, see structure; the list is shared
+            until the content changes, so neither it nor the dicts should be modified
+        """
+        if self._structure_cache and self._structure_cache[0] == content:
+            return self._structure_cache[1]
+
         def _rstrip_eol(text, line_continuation_char='\\'):
             text = text.rstrip()
             if text.endswith(line_continuation_char):
@@ -254,37 +366,28 @@ class DockerfileParser(object):
             }
 
         def _clean_comment_line(line):
-            line = re.sub(r'^\s*#\s*', '', line)
-            line = re.sub(r'\n', '', line)
-            return line
+            # only called for comment lines, so the first non-whitespace is '#'
+            return line.lstrip()[1:].lstrip().replace('\n', '')
 
         instructions = []
         lineno = -1
         line_continuation_char = '\\'
-        insnre = re.compile(r'^\s*(\S+)\s+(.*)$')  # matched group is insn
-        contre = re.compile(r'^.*\\\s*$')          # line continues?
-        commentre = re.compile(r'^\s*#')           # line is a comment?
         directive_possible = True
-        # escape directive regex
-        escape_directive_re = re.compile(r'^\s*#\s*escape\s*=\s*(\\|`)\s*$', re.I)
-        # syntax directive regex
-        syntax_directive_re = re.compile(r'^\s*#\s*syntax\s*=\s*(.*)\s*$', re.I)
 
         in_continuation = False
         current_instruction = {}
 
-        for line in self.lines:
+        for line in self._split_content(content):
             lineno += 1
 
             if directive_possible:
                 # once support for python versions before 3.8 is dropped use walrus operator
-                if escape_directive_re.match(line):
+                if _ESCAPE_DIRECTIVE_RE.match(line):
                     # Do the matching twice if there is a directive to avoid doing the matching
                     # for other lines
-                    match = escape_directive_re.match(line)
+                    match = _ESCAPE_DIRECTIVE_RE.match(line)
                     line_continuation_char = match.group(1)
-                    contre = re.compile(r'^.*' + re.escape(match.group(1)) + r'\s*$')
-                elif syntax_directive_re.match(line):
+                elif _SYNTAX_DIRECTIVE_RE.match(line):
                     # Currently no information for the syntax directive is stored it is still
                     # necessary to detect escape directives after a syntax directive
                     pass
@@ -293,7 +396,7 @@ class DockerfileParser(object):
 
             # It is necessary to keep instructions and comment parsing separate,
             # as a multi-line instruction can be interjected with comments.
-            if commentre.match(line):
+            if _COMMENT_RE.match(line):
                 comment = _create_instruction_dict(
                     instruction=COMMENT_INSTRUCTION,
                     value=_clean_comment_line(line)
@@ -302,12 +405,13 @@ class DockerfileParser(object):
 
             else:
                 if not in_continuation:
-                    m = insnre.match(line)
+                    m = _INSTRUCTION_RE.match(line)
                     if not m:
                         continue
+                    instruction, value = m.groups()
                     current_instruction = _create_instruction_dict(
-                        instruction=m.groups()[0].upper(),
-                        value=_rstrip_eol(m.groups()[1], line_continuation_char)
+                        instruction=intern(instruction.upper()),
+                        value=_rstrip_eol(value, line_continuation_char)
                     )
                 else:
                     current_instruction['content'] += line
@@ -319,10 +423,12 @@ class DockerfileParser(object):
                         current_instruction['value'] = _rstrip_eol(line.lstrip(),
                                                                    line_continuation_char)
 
-                in_continuation = contre.match(line)
+                # line continues? (ends with the line continuation character)
+                in_continuation = line.rstrip().endswith(line_continuation_char)
                 if not in_continuation and current_instruction:
                     instructions.append(current_instruction)
 
+        self._structure_cache = (content, instructions)
         return instructions
 
     @property
@@ -490,15 +596,41 @@ class DockerfileParser(object):
         :param env_replace: bool, whether to perform ENV substitution
         :return: Labels instance or Envs instance
         """
-        if name not in ('LABEL', 'ENV', 'ARG'):
+        if name not in _KEY_VALUE_INSTRUCTIONS:
             raise ValueError("Unsupported instruction '{0}'".format(name))
+
+        content = self.content
+        cache_key = (content, env_replace, dict(self.build_args), dict(self.parent_env))
+        cached = self._instruction_cache.get(name)
+        if cached and cached[0] == cache_key:
+            instructions = dict(cached[1])
+        else:
+            instructions = self._get_instructions(name, env_replace, content)
+            self._instruction_cache[name] = (cache_key, dict(instructions))
+
+        if name == 'LABEL':
+            return Labels(instructions, self)
+        elif name == 'ENV':
+            return Envs(instructions, self)
+        else:
+            return Args(instructions, self)
+
+    def _get_instructions(self, name, env_replace, content):
+        """
+        Compute the values of LABEL or ENV or ARG instructions for _instruction_getter()
+
+        :param name: e.g. 'LABEL' or 'ENV' or 'ARG'
+        :param env_replace: bool, whether to perform ENV substitution
+        :param content: string (unicode) with Dockerfile content
+        :return: dict
+        """
         in_stage = False
         top_args = {}
         instructions = {}
         args = {}
         envs = {}
 
-        for instruction_desc in self.structure:
+        for instruction_desc in self._structure_for(content):
             this_instruction = instruction_desc['instruction']
             if this_instruction == 'FROM':
                 in_stage = True
@@ -530,12 +662,7 @@ class DockerfileParser(object):
                         envs[key] = value
 
         logger.debug("instructions: %r", instructions)
-        if name == 'LABEL':
-            return Labels(instructions, self)
-        elif name == 'ENV':
-            return Envs(instructions, self)
-        else:
-            return Args(instructions, self)
+        return instructions
 
     @labels.setter
     def labels(self, labels):
@@ -576,21 +703,24 @@ class DockerfileParser(object):
 
         logger.debug("setting %s instructions: %r", name, instructions)
 
-        to_delete = [k for k in existing if k not in instructions]
-        for key in to_delete:
-            logger.debug("delete %r", key)
-            self._modify_instruction_label_env(name, key, None)
-
-        to_add = dict((k, v) for (k, v) in instructions.items() if k not in existing)
-        for k, v in to_add.items():
-            logger.debug("add %r", k)
-            self._add_instruction(name, (k, v))
-
-        to_change = dict((k, v) for (k, v) in instructions.items()
-                         if (k in existing and v != existing[k]))
-        for k, v in to_change.items():
-            logger.debug("modify %r", k)
-            self._modify_instruction_label_env(name, k, v)
+        # write the Dockerfile once, after all the changes;
+        # if one of them fails, none of them is written
+        with self.edit():
+            to_delete = [k for k in existing if k not in instructions]
+            for key in to_delete:
+                logger.debug("delete %r", key)
+                self._modify_instruction_label_env(name, key, None)
+
+            to_add = dict((k, v) for (k, v) in instructions.items() if k not in existing)
+            for k, v in to_add.items():
+                logger.debug("add %r", k)
+                self._add_instruction(name, (k, v))
+
+            to_change = dict((k, v) for (k, v) in instructions.items()
+                             if (k in existing and v != existing[k]))
+            for k, v in to_change.items():
+                logger.debug("modify %r", k)
+                self._modify_instruction_label_env(name, k, v)
 
     def _modify_instruction_label(self, label_key, instr_value):
         self._modify_instruction_label_env('LABEL', label_key, instr_value)
@@ -716,7 +846,7 @@ class DockerfileParser(object):
         :param instruction: instruction name to be added
         :param value: instruction value
         """
-        if instruction in ('LABEL', 'ENV', 'ARG') and len(value) == 2:
+        if instruction in _KEY_VALUE_INSTRUCTIONS and len(value) == 2:
             new_line = instruction + ' ' + '='.join(map(quote, value)) + '\n'
         else:
             new_line = '{0} {1}\n'.format(instruction, value)
@@ -755,19 +885,23 @@ class DockerfileParser(object):
         if df_lines and not at_start:
             df_lines[-1] = _endline(df_lines[-1])
 
-        # iterate through the stages in reverse order
-        # so adding lines doesn't invalidate line numbers from structure dicts.
+        # build the new lines in a single pass through the stages,
+        # copying the original lines up to each insertion point.
         # first add a bogus instruction to represent EOF in our iteration.
         froms.append({'startline': len(df_lines) + 1})
-        for stage in range(len(froms)-2, -1, -1):  # e.g. 0 for single or 2, 1, 0 for 3 stages
-            start, finish = froms[stage], froms[stage+1]
-            linenum = start['endline'] + 1 if at_start else finish['startline']
-            image, _ = image_from(froms[stage].get('value') or '')
+        new_lines = []
+        copied = 0
+        for start, finish in zip(froms, froms[1:]):
+            image, _ = image_from(start.get('value') or '')
             if skip_scratch and image == 'scratch':
                 continue
-            df_lines[linenum:linenum] = lines
+            linenum = start['endline'] + 1 if at_start else finish['startline']
+            new_lines.extend(df_lines[copied:linenum])
+            new_lines.extend(lines)
+            copied = linenum
+        new_lines.extend(df_lines[copied:])
 
-        self.lines = df_lines
+        self.lines = new_lines
 
     def add_lines_at(self, anchor, *lines, **kwargs):
         """
@@ -798,10 +932,12 @@ class DockerfileParser(object):
             else:
                 anchor = anchor['startline']
         elif isinstance(anchor, str):  # line contents
-            matches = [index for index, text in enumerate(df_lines) if text == anchor]
-            if not matches:
+            # the last matching line
+            index = next((index for index in range(len(df_lines) - 1, -1, -1)
+                          if df_lines[index] == anchor), None)
+            if index is None:
                 raise RuntimeError("Cannot find line in the build file:\n" + anchor)
-            anchor = matches[-1]
+            anchor = index
             if replace:
                 del df_lines[anchor]
         else:
@@ -812,8 +948,8 @@ class DockerfileParser(object):
             df_lines[anchor] = _endline(df_lines[anchor])
             anchor += 1
 
-        df_lines[anchor:anchor] = [_endline(line) for line in lines]
-        self.lines = df_lines
+        new_lines = ''.join(_endline(line) for line in lines)
+        self.content = ''.join(df_lines[:anchor]) + new_lines + ''.join(df_lines[anchor:])
 
     @property
     def context_structure(self):
@@ -821,35 +957,42 @@ class DockerfileParser(object):
         :return: list of Context objects
             (Contains info about build arguments, labels, and environment variables for each line.)
         """
+        content = self.content
+        cache_key = (content, self.env_replace, dict(self.build_args), dict(self.parent_env))
+        if self._context_structure_cache and self._context_structure_cache[0] == cache_key:
+            return [_copy_context(context) for context in self._context_structure_cache[1]]
+
         in_stage = False
         top_args = {}
         instructions = []
         last_context = Context()
-        for instr in self.structure:
+        for instr in self._structure_for(content):
             instruction_type = instr['instruction']
             if instruction_type == "FROM":  # reset per stage
                 in_stage = True
                 last_context = Context(envs=dict(self.parent_env))
 
-            context = Context(args=dict(last_context.args),
-                              envs=dict(last_context.envs),
-                              labels=dict(last_context.labels))
+            # share the values with the previous line, set_line_value() copies them on change
+            context = Context(args=last_context.args,
+                              envs=last_context.envs,
+                              labels=last_context.labels)
 
-            if instruction_type in ('ARG', 'ENV', 'LABEL'):
+            if instruction_type in _KEY_VALUE_INSTRUCTIONS:
                 values = get_key_val_dictionary(
                     instruction_value=instr['value'],
                     env_replace=instruction_type != 'ARG' and self.env_replace,
                     args=last_context.args,
                     envs=last_context.envs)
                 if instruction_type == 'ARG' and self.env_replace:
+                    # only existing keys are updated, so the dict can be iterated directly
                     if in_stage:
-                        for key in list(values.keys()):
+                        for key in values:
                             if key in top_args:
                                 values[key] = top_args[key]
                             elif key in self.build_args:
                                 values[key] = self.build_args[key]
                     else:
-                        for key, value in list(values.items()):
+                        for key, value in values.items():
                             if key in self.build_args:
                                 value = self.build_args[key]
                             top_args[key] = value
@@ -858,7 +1001,10 @@ class DockerfileParser(object):
 
             instructions.append(context)
             last_context = context
-        return instructions
+
+        # the contexts share their dicts, callers get their own copies
+        self._context_structure_cache = (cache_key, instructions)
+        return [_copy_context(context) for context in instructions]
 
 
 def image_from(from_value):
@@ -866,20 +1012,35 @@ def image_from(from_value):
     :param from_value: string like "image:tag" or "image:tag AS name"
     :return: tuple of the image and stage name, e.g. ("image:tag", None)
     """
-    regex = re.compile(r"""(?xi)        # readable, case-insensitive regex
-        \s*                             # ignore leading whitespace
-        (?P<platform> --platform=\S+)?  # optional platform parameter
-        \s*                             # more whitespaces
-        (?P<image> \S+ )                # image and optional tag
-        (?:                             # optional "AS name" clause for stage
-            \s+ AS \s+
-            (?P<name> \S+ )
-        )?
-        """)
-    match = re.match(regex, from_value)
+    match = _IMAGE_FROM_RE.match(from_value)
     return match.group('image', 'name') if match else (None, None)
 
 
+def _copy_context(context):
+    """
+    :param context: Context object
+    :return: Context object with copies of the dicts of context
+    """
+    return Context(args=dict(context.args),
+                   envs=dict(context.envs),
+                   labels=dict(context.labels),
+                   line_args=dict(context.line_args),
+                   line_envs=dict(context.line_envs),
+                   line_labels=dict(context.line_labels))
+
+
+def _split_lines(content):
+    """
+    Split content into lines keeping line endings; unlike str.splitlines(),
+    split only at newlines, the same way readlines() does on the Dockerfile.
+    """
+    lines = [line + '\n' for line in content.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
 def _endline(line):
     """
     Make sure the line ends with a single newline.
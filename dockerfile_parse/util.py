@@ -7,7 +7,9 @@ This software may be modified and distributed under the terms
 of the BSD license. See the LICENSE file for details.
 """
 
-from io import StringIO
+import re
+from itertools import chain
+from sys import intern
 
 
 def b2u(string):
@@ -37,9 +39,72 @@ class WordSplitter(object):
         Returns an iterable of words, split at whitespace
     """
 
+    # a WordSplitter is created for many short strings, keep them small
+    __slots__ = ('s', 'pos', 'args', 'envs', 'quotes', 'escaped')
+
     SQUOTE = "'"
     DQUOTE = '"'
 
+    # characters which may change the state of the word splitter,
+    # by quoting state and whether variables are substituted
+    _SPECIALS = {
+        (None, False): re.compile(r'[\'"\\]'),
+        (None, True): re.compile(r'[\'"\\$]'),
+        (DQUOTE, False): re.compile(r'["\\]'),
+        (DQUOTE, True): re.compile(r'["\\$]'),
+        (SQUOTE, False): re.compile(r"'"),
+        (SQUOTE, True): re.compile(r"'"),
+    }
+    # as above, for unquoted words which may still be split at whitespace
+    _SPLIT_SPECIALS = {
+        False: re.compile(r'[\s\'"\\]'),
+        True: re.compile(r'[\s\'"\\$]'),
+    }
+
+    # characters with their own transitions in the quoting state machine
+    _QUOTING_CHARS = frozenset(('\\', DQUOTE, SQUOTE))
+
+    # Quoting state machine:
+    #   (quotes, escaped, character) -> (quotes, escaped, prefix)
+    # where character is one of _QUOTING_CHARS or None for any other one,
+    # and the character is consumed if prefix is None, else prefix + character is kept.
+    # Unquoted:
+    #   a backslash escapes the next character
+    # Double-quoted:
+    #   a backslash escapes the next character, but is only consumed
+    #   if that is a double-quote
+    # Single-quoted:
+    #   a backslash is not special
+    _TRANSITIONS = {
+        (None, False, '\\'): (None, True, None),
+        (None, False, DQUOTE): (DQUOTE, False, None),
+        (None, False, SQUOTE): (SQUOTE, False, None),
+        (None, False, None): (None, False, ''),
+        (None, True, '\\'): (None, False, ''),
+        (None, True, DQUOTE): (None, False, ''),
+        (None, True, SQUOTE): (None, False, ''),
+        (None, True, None): (None, False, ''),
+        (DQUOTE, False, '\\'): (DQUOTE, True, None),
+        (DQUOTE, False, DQUOTE): (None, False, None),
+        (DQUOTE, False, SQUOTE): (DQUOTE, False, ''),
+        (DQUOTE, False, None): (DQUOTE, False, ''),
+        (DQUOTE, True, '\\'): (DQUOTE, False, '\\'),
+        (DQUOTE, True, DQUOTE): (DQUOTE, False, ''),
+        (DQUOTE, True, SQUOTE): (DQUOTE, False, '\\'),
+        (DQUOTE, True, None): (DQUOTE, False, '\\'),
+        (SQUOTE, False, '\\'): (SQUOTE, False, ''),
+        (SQUOTE, False, DQUOTE): (SQUOTE, False, ''),
+        (SQUOTE, False, SQUOTE): (None, False, None),
+        (SQUOTE, False, None): (SQUOTE, False, ''),
+    }
+
+    # ASCII characters the words are split at; other ones are checked
+    # with str.isspace()
+    _ASCII_WHITESPACE = frozenset(chr(i) for i in range(128) if chr(i).isspace())
+
+    # a variable reference following '$': optional opening braces and the name
+    _VARNAME = re.compile(r'(\{*)(\w*)')
+
     def __init__(self, s, args=None, envs=None):
         """
         :param s: str, string to process
@@ -48,7 +113,8 @@ class WordSplitter(object):
         :param envs: dict, environment variables to use; if None, do not
             attempt substitution
         """
-        self.stream = StringIO(s)
+        self.s = s
+        self.pos = 0  # index of the next character to process
         self.args = args
         self.envs = envs
 
@@ -56,6 +122,18 @@ class WordSplitter(object):
         self.quotes = None  # the quoting character in force, or None
         self.escaped = False
 
+    def _find_special(self, specials):
+        """
+        :param specials: compiled regex matching the characters to look for
+        :return: int, index of the first of specials found from the current
+            position on, or the length of the string if there is none
+        """
+        match = specials.search(self.s, self.pos)
+        if match is None:
+            return len(self.s)
+
+        return match.start()
+
     def _update_quoting_state(self, ch):
         """
         Update self.quotes and self.escaped
@@ -63,41 +141,20 @@ class WordSplitter(object):
         :param ch: str, current character
         :return: ch if it was not used to update quoting state, else ''
         """
-
-        # Set whether the next character is escaped
-        # Unquoted:
-        #   a backslash escapes the next character
-        # Double-quoted:
-        #   a backslash escapes the next character only if it is a double-quote
-        # Single-quoted:
-        #   a backslash is not special
-        is_escaped = self.escaped
-        self.escaped = (not self.escaped and
-                        ch == '\\' and
-                        self.quotes != self.SQUOTE)
-        if self.escaped:
-            return ''
-
-        if is_escaped:
-            if self.quotes == self.DQUOTE:
-                if ch == '"':
-                    return ch
-                return "{0}{1}".format('\\', ch)
-
-            return ch
-
-        if self.quotes is None:
-            if ch in (self.SQUOTE, self.DQUOTE):
-                self.quotes = ch
-                return ''
-
-        elif self.quotes == ch:
-            self.quotes = None
+        char_class = ch if ch in self._QUOTING_CHARS else None
+        state = (self.quotes, self.escaped, char_class)
+        self.quotes, self.escaped, prefix = self._TRANSITIONS[state]
+        if prefix is None:
             return ''
 
-        return ch
+        return prefix + ch
 
     def dequote(self):
+        if ('\\' not in self.s and '"' not in self.s and "'" not in self.s and
+                ((self.args is None and self.envs is None) or '$' not in self.s)):
+            # Nothing to dequote or substitute
+            return self.s
+
         return ''.join(self.split(maxsplit=0))
 
     def split(self, maxsplit=None, dequote=True):
@@ -109,67 +166,70 @@ class WordSplitter(object):
         :param dequote: remove quotes and escape characters once consumed
         """
 
-        class Word(object):
-            """
-            A None-or-str object which can always be appended to.
-            Similar to a defaultdict but with only a single value.
-            """
-
-            def __init__(self):
-                self.value = None
-
-            @property
-            def valid(self):
-                return self.value is not None
-
-            def append(self, s):
-                if self.value is None:
-                    self.value = s
-                else:
-                    self.value += s
-
+        substitute = ((self.envs is not None or self.args is not None) and
+                      '$' in self.s)
+        if (maxsplit is None and not substitute and
+                '\\' not in self.s and '"' not in self.s and "'" not in self.s):
+            # Nothing to substitute or dequote, plain whitespace splitting will do
+            self.pos = len(self.s)
+            yield from self.s.split()
+            return
+
+        # environment variables take precedence over build arguments
+        lookups = [values.get for values in (self.envs, self.args) if values is not None]
+        s = self.s
+        length = len(s)
         num_splits = 0
-        word = Word()
+        # parts of the current word; it may be empty but still valid,
+        # e.g. after an empty pair of quotes
+        word = []
+        word_valid = False
         while True:
-            ch = self.stream.read(1)
+            may_split = maxsplit != 0 and (maxsplit is None or
+                                           num_splits < maxsplit)
+            if not self.escaped:
+                # Characters up to the next special one can neither change
+                # the state nor split the word, take them all at once
+                if may_split and self.quotes is None:
+                    specials = self._SPLIT_SPECIALS[substitute]
+                else:
+                    specials = self._SPECIALS[self.quotes, substitute]
+
+                end = self._find_special(specials)
+                if end > self.pos:
+                    word.append(self.s[self.pos:end])
+                    word_valid = True
+                    self.pos = end
+
+            ch = s[self.pos] if self.pos < length else ''
+            self.pos += 1
             if not ch:
                 # EOF
-                if word.valid:
-                    yield word.value
+                if word_valid:
+                    yield ''.join(word)
 
                 return
 
             if (not self.escaped and
-                    (self.envs is not None or self.args is not None) and
+                    substitute and
                     ch == '$' and
                     self.quotes != self.SQUOTE):
                 while True:
                     # Substitute environment variable
-                    braced = False
-                    varname = ''
-                    while True:
-                        ch = self.stream.read(1)
-                        if varname == '' and ch == '{':
-                            braced = True
-                            continue
-
-                        if not ch:
-                            # EOF
-                            break
-
-                        if braced and ch == '}':
-                            break
-
-                        if not ch.isalnum() and ch != '_':
+                    match = self._VARNAME.match(s, self.pos)
+                    braced = bool(match.group(1))
+                    varname = match.group(2)
+                    self.pos = match.end()
+                    # the character after the name; it ends the name
+                    ch = s[self.pos] if self.pos < length else ''
+                    self.pos += 1
+                    for lookup in lookups:
+                        value = lookup(varname)
+                        if value is not None:
+                            word.append(value)
+                            word_valid = True
                             break
 
-                        varname += ch
-
-                    if self.envs is not None and varname in self.envs:
-                        word.append(self.envs[varname])
-                    elif self.args is not None and varname in self.args:
-                        word.append(self.args[varname])
-
                     # Check whether there is another envvar
                     if ch != '$':
                         break
@@ -191,35 +251,57 @@ class WordSplitter(object):
 
             # If word-splitting has been requested, check whether we are
             # at a whitespace character
-            may_split = maxsplit != 0 and (maxsplit is None or
-                                           num_splits < maxsplit)
             at_split = may_split and (self.quotes is None and
                                       not is_escaped and
-                                      ch.isspace())
+                                      (ch in self._ASCII_WHITESPACE or
+                                       (ch > '\x7f' and ch.isspace())))
             if at_split:
                 # It is time to yield a word
-                if word.valid:
+                if word_valid:
                     num_splits += 1
-                    yield word.value
+                    yield ''.join(word)
 
-                word = Word()
+                word = []
+                word_valid = False
             else:
                 word.append(ch)
+                word_valid = True
 
 
-def extract_key_values(env_replace, args, envs, instruction_value):
-    words = list(WordSplitter(instruction_value).split(dequote=False))
-    key_val_list = []
+# characters which make extract_key_values dequote or substitute
+_QUOTING_OR_SUBSTITUTION = re.compile(r'[\\"\'$]')
+
+
+def _iter_key_values(env_replace, args, envs, instruction_value):
+    """
+    Generator for the (key, value) pairs of a LABEL/ENV/ARG instruction value
+    """
+    if _QUOTING_OR_SUBSTITUTION.search(instruction_value) is None:
+        # Nothing to dequote or substitute, plain string methods will do
+        words = instruction_value.split()
+        if words and '=' not in words[0]:
+            key_val = instruction_value.split(None, 1)
+            yield key_val[0], (key_val[1] if len(key_val) > 1 else '')
+            return
+
+        if words and all('=' in word for word in words):
+            for word in words:
+                key, val = word.split('=', 1)
+                yield key, val
+            return
+
+    # The first word tells which form is used, the rest is only needed
+    # for the name=value form
+    words = WordSplitter(instruction_value).split(dequote=False)
+    first_word = next(words, '')
 
     def substitute_vars(val):
-        kwargs = {}
         if env_replace:
-            kwargs['args'] = args
-            kwargs['envs'] = envs
+            return WordSplitter(val, args=args, envs=envs).dequote()
 
-        return WordSplitter(val, **kwargs).dequote()
+        return WordSplitter(val).dequote()
 
-    if '=' not in words[0]:
+    if '=' not in first_word:
         # This form is:
         #   LABEL/ENV name value
         # The first word is the name, remainder are the value.
@@ -230,31 +312,45 @@ def extract_key_values(env_replace, args, envs, instruction_value):
         except IndexError:
             val = ''
 
-        key_val_list.append((key, val))
+        yield key, val
     else:
         # This form is:
         #   LABEL/ENV "name"="value" ["name"="value"...]
         # Each word is a key=value pair.
-        for k_v in words:
+        for k_v in chain([first_word], words):
             if '=' not in k_v:
                 raise ValueError('Syntax error - can\'t find = in "{word}". '
                                  'Must be of the form: name=value'
                                  .format(word=k_v))
             key, val = [substitute_vars(x) for x in k_v.split('=', 1)]
-            key_val_list.append((key, val))
+            yield key, val
 
-    return key_val_list
+
+def extract_key_values(env_replace, args, envs, instruction_value):
+    return list(_iter_key_values(env_replace, args, envs, instruction_value))
 
 
 def get_key_val_dictionary(instruction_value, env_replace=False, args=None, envs=None):
     args = args or {}
     envs = envs or {}
-    return dict(extract_key_values(instruction_value=instruction_value,
-                                   env_replace=env_replace,
-                                   args=args, envs=envs))
+    # the same keys show up in the dicts of many lines, share them
+    return {intern(key): value
+            for key, value in _iter_key_values(instruction_value=instruction_value,
+                                               env_replace=env_replace,
+                                               args=args, envs=envs)}
 
 
 class Context(object):
+    # there is a Context for every line of the Dockerfile, keep them small
+    __slots__ = ('args', 'envs', 'labels', 'line_args', 'line_envs', 'line_labels')
+
+    # names of the attributes with values defined on / valid for the line
+    _ATTRIBUTES = {
+        'ARG': ('line_args', 'args'),
+        'ENV': ('line_envs', 'envs'),
+        'LABEL': ('line_labels', 'labels'),
+    }
+
     def __init__(self, args=None, envs=None, labels=None,
                  line_args=None, line_envs=None, line_labels=None):
         """
@@ -277,25 +373,38 @@ class Context(object):
         self.line_envs = line_envs or {}
         self.line_labels = line_labels or {}
 
+    def _attributes(self, context_type):
+        """
+        :param context_type: "ARG" or "ENV" or "LABEL"
+        :return: tuple, names of the attributes with values defined on this line
+            and valid on this line
+        """
+        attributes = self._ATTRIBUTES.get(context_type)
+        if attributes is None:
+            # callers mostly pass the canonical upper-case names, only
+            # normalize the case if they did not
+            attributes = self._ATTRIBUTES.get(context_type.upper())
+
+        if attributes is None:
+            raise ValueError("Unexpected context type: " + context_type)
+        return attributes
+
     def set_line_value(self, context_type, value):
         """
         Set value defined on this line ('line_args'/'line_envs'/'line_labels')
         and update 'args'/'envs'/'labels'.
 
+        The dict with values valid on this line is replaced by an updated copy,
+        so it may be shared with other contexts.
+
         :param context_type: "ARG" or "ENV" or "LABEL"
         :param value: new value for this line
         """
-        if context_type.upper() == "ARG":
-            self.line_args = value
-            self.args.update(value)
-        elif context_type.upper() == "ENV":
-            self.line_envs = value
-            self.envs.update(value)
-        elif context_type.upper() == "LABEL":
-            self.line_labels = value
-            self.labels.update(value)
-        else:
-            raise ValueError("Unexpected context type: " + context_type)
+        line_attribute, attribute = self._attributes(context_type)
+        setattr(self, line_attribute, value)
+        values = dict(getattr(self, attribute))
+        values.update(value)
+        setattr(self, attribute, values)
 
     def get_line_value(self, context_type):
         """
@@ -304,13 +413,7 @@ class Context(object):
         :param context_type: "ARG" or "ENV" or "LABEL"
         :return: values of given type defined on this line
         """
-        if context_type.upper() == "ARG":
-            return self.line_args
-        if context_type.upper() == "ENV":
-            return self.line_envs
-        if context_type.upper() == "LABEL":
-            return self.line_labels
-        raise ValueError("Unexpected context type: " + context_type)
+        return getattr(self, self._attributes(context_type)[0])
 
     def get_values(self, context_type):
         """
@@ -319,10 +422,4 @@ class Context(object):
         :param context_type: "ARG" or "ENV" or "LABEL"
         :return: values of given type valid on this line
         """
-        if context_type.upper() == "ARG":
-            return self.args
-        if context_type.upper() == "ENV":
-            return self.envs
-        if context_type.upper() == "LABEL":
-            return self.labels
-        raise ValueError("Unexpected context type: " + context_type)
+        return getattr(self, self._attributes(context_type)[1])
@@ -15,16 +15,25 @@ import pytest
 from dockerfile_parse import DockerfileParser
 
 
+def _reset(parser):
+    parser.env_replace = True
+    parser.parent_env = {}
+    parser.build_args = {}
+    parser.content = ''
+    return parser
+
+
 @pytest.fixture(
+    scope='module',
     params=[(use_fileobj, cache_content)
             for use_fileobj in [True, False]
             for cache_content in [True, False]])
-def dfparser(tmpdir, request):
+def dfparser_instance(tmp_path_factory, request):
     """
 
-    :param tmpdir: already existing fixture defined in pytest
+    :param tmp_path_factory: already existing fixture defined in pytest
     :param request: parameter, cache_content arg to DockerfileParser
-    :return: DockerfileParser instance
+    :return: DockerfileParser instance, shared by the tests of a module
     """
 
     use_fileobj, cache_content = request.param
@@ -32,10 +41,48 @@ def dfparser(tmpdir, request):
         fileobj = io.BytesIO()
         return DockerfileParser(fileobj=fileobj, cache_content=cache_content)
     else:
-        tmpdir_path = str(tmpdir.realpath())
+        tmpdir_path = str(tmp_path_factory.mktemp('dfparser'))
         return DockerfileParser(path=tmpdir_path, cache_content=cache_content)
 
 
+@pytest.fixture
+def dfparser(dfparser_instance):
+    """
+    The DockerfileParser instance for the current parameter, reset to empty content and
+    default settings
+
+    :param dfparser_instance: DockerfileParser instance to reset
+    :return: DockerfileParser instance
+    """
+    return _reset(dfparser_instance)
+
+
+@pytest.fixture(scope='module', params=['fileobj', 'path_cache_content'])
+def dfparser_module(tmp_path_factory, request):
+    """
+    :param tmp_path_factory: already existing fixture defined in pytest
+    :param request: parameter, in-memory content or a Dockerfile path with cache_content
+    :return: DockerfileParser instance, shared by the tests of a module
+    """
+    if request.param == 'fileobj':
+        return DockerfileParser(fileobj=io.BytesIO())
+    else:
+        tmpdir_path = str(tmp_path_factory.mktemp('dfparser_module'))
+        return DockerfileParser(path=tmpdir_path, cache_content=True)
+
+
+@pytest.fixture
+def dfparser_shared(dfparser_module):
+    """
+    For tests which only parse the content they set: the shared DockerfileParser instance,
+    reset to empty content and default settings
+
+    :param dfparser_module: DockerfileParser instance to reset
+    :return: DockerfileParser instance
+    """
+    return _reset(dfparser_module)
+
+
 @pytest.fixture(params=['LABEL', 'ENV', 'ARG'])
 def instruction(request):
     """
@@ -20,11 +20,444 @@ from dockerfile_parse import DockerfileParser
 from dockerfile_parse.parser import image_from
 from dockerfile_parse.constants import COMMENT_INSTRUCTION
 from dockerfile_parse.util import b2u, u2b, Context
-from tests.fixtures import dfparser, instruction
+from tests.fixtures import (dfparser, dfparser_instance, dfparser_module, dfparser_shared,
+                            instruction)
 
 NON_ASCII = "žluťoučký"
+USER_LINE_NON_ASCII = "USER  " + NON_ASCII + "\n"
+DF_CONTENT = "FROM fedora\nLABEL label=" + NON_ASCII
+DF_LINES = DF_CONTENT.splitlines(keepends=True)
+SPEC_VERSION_RE = re.compile(r"^Version:\s*(.+?)\s*$")
+SETUP_PY_VERSION_RE = re.compile(r"version=['\"](.+)['\"]")
+# ARG/ENV definitions used by the variable substitution tests
+ARG_ENV_BASE_LINES = {
+    instr: ["FROM fedora\n", "{0} V=v\n".format(instr)]
+    for instr in ('ARG', 'ENV')
+}
+ARG_ENV_REPLACE_BASE_LINES = {
+    instr: ARG_ENV_BASE_LINES[instr] + ["{0} VS='spam maps'\n".format(instr)]
+    for instr in ('ARG', 'ENV')
+}
+CONTEXT_STRUCTURE_PER_LINE_TEMPLATE = dedent("""\
+    FROM fedora:25
+
+    {0} multi.label❤1="value❤1" \\
+          multi.label❤2="value❤2" \\
+          other="value❤3"
+
+    {0} 2multi.label1="othervalue1" 2multi.label2="othervalue2" other="othervalue3"
+
+    {0} "com.example.vendor"="ACME Incorporated"
+    {0} com.example.label-with-value="foo"
+    {0} version="1.0.❤"
+    {0} description="This text illustrates ❤ \\
+    that label-values can span multiple lines."
+    {0} key="with = in the value❤"
+    """)
+CONTEXT_STRUCTURE_TEMPLATE = dedent("""\
+    FROM fedora:25
+
+    {0} multi.label❤1="value❤1" \\
+          multi.label❤2="value❤2" \\
+          other="value❤3"
+
+    {0} 2multi.label1="othervalue1" 2multi.label2="othervalue2" other="othervalue3"
+
+    {0} "com.example.vendor"="ACME Incorporated"
+    {0} com.example.label-with-value="foo"
+    {0} version="1.0.❤"
+    {0} description="This text illustrates \\
+    that label-values can span multiple lines."
+    """)
+CONTEXT_STRUCTURE_MIXED_TEMPLATE = dedent("""\
+    FROM fedora:25
+
+    {0} key=value❤
+    RUN touch /tmp/a
+    {0} key2=value2❤""")
+CONTEXT_STRUCTURE_MIXED_LABEL_TEMPLATE = dedent("""\
+    FROM fedora:25
+
+    {0} key=value❤
+    RUN touch /tmp/a
+    LABEL key2=value2❤""")
+SETTER_DIRECT_TEMPLATE = dedent("""\
+    FROM xyz
+    LABEL a b
+    LABEL x=\"y z\"
+    ENV c d
+    ENV e=\"f g\"
+    {0} {1}
+    """)
+ADD_DEL_INSTRUCTION_CONTENT = dedent("""\
+    CMD xyz
+    LABEL a=b c=d
+    LABEL x=\"y z\"
+    ENV h i
+    ENV j='k' l=m
+    ARG a b
+    ARG c='d' e=f
+    """)
+MODIFY_INSTRUCTION_TEMPLATE = dedent("""\
+    FROM {0}
+    CMD {1}""")
+MODIFY_FROM_MULTISTAGE_TEMPLATE = dedent("""\
+    ARG  CODE_VERSION={0}
+    FROM {1}
+    CMD {2}
+
+    FROM {3}
+    """)
+ADD_LINES_SCRATCH_STAGES_CONTENT = dedent("""\
+    From builder
+    CMD xyz ❤
+    From scratch
+    LABEL type=scratch
+    From base
+    LABEL a=b c=d
+    ENV h i
+    From scratch
+    LABEL type=scratch2
+    From scratch as foo
+    LABEL type=scratch3
+    """)
+ADD_LINES_AT_CONTENT = dedent("""\
+    From builder
+    CMD xyz ❤
+    LABEL a=b c=d
+    CMD xyz ❤
+    """)
+ADD_LINES_AFTER_CONTINUATION_CONTENT = dedent("""\
+    FROM builder
+    RUN touch foo ❤; \\
+        touch bar
+    """)
+REPLACE_LINES_CONTINUATION_CONTENT = dedent("""\
+    FROM builder
+    RUN touch foo; \\
+        touch bar ❤
+    """)
+
+DOCKERFILE_STRUCTURE_LINES = [
+    "# comment\n",                # single-line comment
+    " From  \\\n",                # mixed-case
+    "   base\n",                  # extra ws, continuation line
+    " #    another   comment\n",  # extra ws
+    " label  foo  \\\n",          # extra ws
+    "# interrupt LABEL\n",        # comment interrupting multi-line LABEL
+    "    bar  \n",                # extra ws, instruction continuation
+    USER_LINE_NON_ASCII,
+    "# comment \\\n",             # extra ws
+    "# with \\ \n",               # extra ws with a space
+    "# backslashes \\\\ \n",      # two backslashes
+    "#no space after hash\n",
+    "# comment # with hash inside\n",
+    "RUN command1\n",
+    "RUN command2 && \\\n",
+    "    command3\n",
+    "RUN command4 && \\\n",
+    "# interrupt RUN\n",          # comment interrupting multi-line RUN
+    "    command5\n",
+]
+
+DOCKERFILE_STRUCTURE = [
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 0,
+     'endline': 0,
+     'content': '# comment\n',
+     'value': 'comment'},
+    {'instruction': 'FROM',
+     'startline': 1,
+     'endline': 2,
+     'content': ' From  \\\n   base\n',
+     'value': 'base'},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 3,
+     'endline': 3,
+     'content': ' #    another   comment\n',
+     'value': 'another   comment'},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 5,
+     'endline': 5,
+     'content': '# interrupt LABEL\n',
+     'value': 'interrupt LABEL'},
+    {'instruction': 'LABEL',
+     'startline': 4,
+     'endline': 6,
+     'content': ' label  foo  \\\n    bar  \n',
+     'value': 'foo      bar'},
+    {'instruction': 'USER',
+     'startline': 7,
+     'endline': 7,
+     'content': USER_LINE_NON_ASCII,
+     'value': NON_ASCII},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 8,
+     'endline': 8,
+     'content': '# comment \\\n',
+     'value': 'comment \\'},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 9,
+     'endline': 9,
+     'content': '# with \\ \n',
+     'value': 'with \\ '},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 10,
+     'endline': 10,
+     'content': '# backslashes \\\\ \n',
+     'value': 'backslashes \\\\ '},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 11,
+     'endline': 11,
+     'content': '#no space after hash\n',
+     'value': 'no space after hash'},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 12,
+     'endline': 12,
+     'content': '# comment # with hash inside\n',
+     'value': 'comment # with hash inside'},
+    {'instruction': 'RUN',
+     'startline': 13,
+     'endline': 13,
+     'content': 'RUN command1\n',
+     'value': 'command1'},
+    {'instruction': 'RUN',
+     'startline': 14,
+     'endline': 15,
+     'content': 'RUN command2 && \\\n    command3\n',
+     'value': 'command2 &&     command3'},
+    {'instruction': COMMENT_INSTRUCTION,
+     'startline': 17,
+     'endline': 17,
+     'content': '# interrupt RUN\n',
+     'value': 'interrupt RUN'},
+    {'instruction': 'RUN',
+     'startline': 16,
+     'endline': 18,
+     'content': 'RUN command4 && \\\n    command5\n',
+     'value': 'command4 &&     command5'},
+]
+
+INSTRUCTION_VALUE_CASES = (
+    # pylint: disable=anomalous-backslash-in-string
+    ('"name1"=\'value 1\' "name2"=myself name3=""',
+     {'name1': 'value 1',
+      'name2': 'myself',
+      'name3': ''}),
+    ('name5=5', {'name5': '5'}),
+    ('"name6"=6', {'name6': '6'}),
+    ('name7', {'name7': ''}),
+    ('"name8"', {'name8': ''}),
+    ('"name9"="asd \\  \\n qwe"', {'name9': 'asd \\  \\n qwe'}),
+    ('"name10"="' + NON_ASCII + '"', {'name10': NON_ASCII}),
+    ('"name1 1"=1', {'name1 1': '1'}),
+    ('"name12"=12 \\ \n   "name13"=13', {'name12': '12', 'name13': '13'}),
+    ('name14=1\\ 4', {'name14': '1 4'}),
+    ('name15="with = in value"', {'name15': 'with = in value'}),
+    ('name16=❤', {'name16': '❤'}),
+    ('name❤=❤', {'name❤': '❤'}),
+    # old syntax (without =)
+    ('name101 101', {'name101': '101'}),
+    ('name102 1 02', {'name102': '1 02'}),
+    ('"name103" 1 03', {'name103': '1 03'}),
+    ('name104 "1"  04', {'name104': '1  04'}),
+    ('name105 1 \'05\'', {'name105': '1 05'}),
+    ('name106 1 \'0\'   6', {'name106': '1 0   6'}),
+    ('name107 1 0\\ 7', {'name107': '1 0 7'}),
+    ('name108 "with = in value"', {'name108': 'with = in value'}),
+    ('name109 "\\"quoted\\""', {'name109': '"quoted"'}),
+    ('name110 ❤', {'name110': '❤'}),
+    ('name1❤ ❤', {'name1❤': '❤'}),
+)
+
+IMAGE_FROM_CASES = (
+    (
+        "    ",
+        (None, None),
+    ), (
+        "   foo",
+        ('foo', None),
+    ), (
+        "foo:bar as baz   ",
+        ('foo:bar', 'baz'),
+    ), (
+        "foo as baz",
+        ('foo', 'baz'),
+    ), (
+        "foo and some other junk",  # we won't judge
+        ('foo', None),
+    ), (
+        "registry.example.com:5000/foo/bar:baz",
+        ('registry.example.com:5000/foo/bar:baz', None),
+    )
+)
+
+DELETE_INSTRUCTION_CASES = (
+    # Delete non-existing key
+    (['a b\n',
+      'x="y z"\n'],
+     'name',
+     KeyError()),
+
+    # Simple remove
+    (['a b\n',
+      'x="y z"\n'],
+     'a',
+     ['x="y z"\n']),
+
+    # Simple remove
+    (['a b\n',
+      'x="y z"\n'],
+     'x',
+     ['a b\n']),
+
+    # Simple remove unicode
+    (['a b\n',
+      'x="y ❤"\n'],
+     'x',
+     ['a b\n']),
+
+    # Simple remove unicode
+    (['a b\n',
+      '❤="y z"\n'],
+     '❤',
+     ['a b\n']),
+
+    #  Remove first of two instructions on the same line
+    (['a b\n',
+      'x="y z"\n',
+      '"first"="first" "second"="second"\n'],
+     'first',
+     ['a b\n',
+      'x="y z"\n',
+      '"second"="second"\n']),
+
+    #  Remove second of two instructions on the same line
+    (['a b\n',
+      'x="y z"\n',
+      '"first"="first" "second"="second"\n'],
+     'second',
+     ['a b\n',
+      'x="y z"\n',
+      '"first"="first"\n']),
+)
+
+SETTER_CASES = (
+    # Simple test: set an instruction
+    (['a b\n',
+      'x="y z"\n'],
+     {'Name': 'New shiny project'},
+     ['Name=\'New shiny project\'\n']),
+
+    # Set two instructions
+    (['a b\n',
+      'x="y z"\n'],
+     {'something': 'nothing', 'mine': 'yours'},
+     ['something=nothing\n', 'mine=yours\n']),
+
+    # Set instructions to what they already were: should be no difference
+    (['a b\n',
+      'x="y z"\n',
+      '"first"="first" second=\'second value\'\n'],
+     {'a': 'b', 'x': 'y z', 'first': 'first', 'second': 'second value'},
+     ['a b\n',
+      'x="y z"\n',
+      '"first"="first" second=\'second value\'\n']),
+
+    # Adjust one label of a multi-value LABEL/ENV statement
+    (['a b\n',
+      'first=\'first value\' "second"=second\n',
+      'x="y z"\n'],
+     {'first': 'changed', 'second': 'second'},
+     ['first=changed "second"=second\n']),
+
+    # Delete one label of a multi-value LABEL/ENV statement
+    (['a b\n',
+      'x="y z"\n',
+      'first=first second=second\n'],
+     {'second': 'second'},
+     ['second=second\n']),
+
+    # Nested quotes
+    (['"ownership"="Alice\'s label" other=value\n'],
+     {'ownership': "Alice's label"},
+     # Keeps existing key quoting style
+     ['"ownership"="Alice\'s label"\n']),
+
+    # Modify a single value that needs quoting
+    (['foo bar\n'],
+     {'foo': 'extra bar'},
+     ["foo 'extra bar'\n"]),
+)
+
+SETTER_DIRECT_CASES = (
+    # Simple case, no '=' or quotes
+    ('Release 1', 'Release', '2', 'Release 2'),
+    # No '=' but quotes (which are kept)
+    ('"Release" "2"', 'Release', '3', '"Release" 3'),
+    # Simple case, '=' but no quotes
+    ('Release=1', 'Release', '6', 'Release=6'),
+    # '=' and quotes, with space in the value
+    ('"Name"=\'alpha alpha\' Version=1',
+     'Name', 'beta delta', '"Name"=\'beta delta\' Version=1'),
+    ('Name=foo', 'Name', 'new value', "Name='new value'"),
+    # ' ' and quotes
+    ('"Name" alpha alpha', 'Name', 'beta delta', "\"Name\" 'beta delta'"),
+    # '=', multiple labels, no quotes
+    ('Name=foo Release=3', 'Release', '4', 'Name=foo Release=4'),
+    # '=', multiple labels and quotes
+    ('Name=\'foo bar\' "Release"="4"', 'Release', '5', 'Name=\'foo bar\' "Release"=5'),
+    # Release that's not entirely numeric
+    ('Version=1.1', 'Version', '2.1', 'Version=2.1'),
+)
+
+ARG_ENV_REPLACE_CASES = (
+    # Expected substitutions
+    ('$V', 'v'),
+    ('"$V"', 'v'),
+    ('$V-foo', 'v-foo'),
+    ('"$V-foo"', 'v-foo'),
+    ('"$V"-foo', 'v-foo'),
+    ('${V}', 'v'),
+    ('${V}-foo', 'v-foo'),
+    ('$V-{foo}', 'v-{foo}'),
+    ('$V-❤', 'v-❤'),
+    ('$VS', 'spam maps'),
+
+    # These should not be substituted, only dequoted
+    ("'$V'", "$V"),
+    ("\\$V", "$V"),
+    ("\\$V❤", "$V❤"),
+
+    # Try to trip up the parser
+    ('\\"$V', '"v'),
+    ("\\'$V", "'v"),
+    ('$V}', 'v}'),
+    ('${}', ''),
+    ("'\\'$V'\\'", "\\v\\"),
+)
+
+ARG_ENV_NOREPLACE_CASES = (
+    # These would have been substituted with env_replace=True
+    ('$V', '$V'),
+    ('"$V"', '$V'),
+    ('$V-foo', '$V-foo'),
+    ('"$V-foo"', '$V-foo'),
+    ('"$V"-foo', '$V-foo'),
+    ('"$V"-❤', '$V-❤'),
+)
+
+ARG_ENV_INVALID_LABELS = (
+    '${V',
+    '"${V"',
+    '${{{{V}',
+)
+
 # flake8 does not understand fixtures:
 dfparser = dfparser  # pylint: disable=self-assigning-variable
+dfparser_instance = dfparser_instance  # pylint: disable=self-assigning-variable
+dfparser_module = dfparser_module  # pylint: disable=self-assigning-variable
+dfparser_shared = dfparser_shared  # pylint: disable=self-assigning-variable
 instruction = instruction  # pylint: disable=self-assigning-variable
 
 
@@ -32,8 +465,7 @@ class TestDockerfileParser(object):
     def test_all_versions_match(self):
         def read_version(fp, regex):
             with open(fp, "r") as fd:
-                content = fd.read()
-                found = re.findall(regex, content)
+                found = [match.group(1) for match in map(regex.search, fd) if match]
                 if len(found) == 1:
                     return found[0]
                 else:
@@ -45,8 +477,8 @@ class TestDockerfileParser(object):
         project_dir = os.path.dirname(os.path.dirname(fp))
         specfile = os.path.join(project_dir, "python-dockerfile-parse.spec")
         setup_py = os.path.join(project_dir, "setup.py")
-        spec_version = read_version(specfile, r"\nVersion:\s*(.+?)\s*\n")
-        setup_py_version = read_version(setup_py, r"version=['\"](.+)['\"]")
+        spec_version = read_version(specfile, SPEC_VERSION_RE)
+        setup_py_version = read_version(setup_py, SETUP_PY_VERSION_RE)
         assert spec_version == module_version
         assert setup_py_version == module_version
 
@@ -67,50 +499,51 @@ class TestDockerfileParser(object):
         with pytest.raises(ValueError):
             context.set_line_value('FOO', {})
 
-    def test_dockerfileparser(self, dfparser, tmpdir):
-        df_content = dedent("""\
-            FROM fedora
-            LABEL label={0}""".format(NON_ASCII))
-        df_lines = ["FROM fedora\n", "LABEL label={0}".format(NON_ASCII)]
+    def test_util_context_shared_values(self):
+        envs = {'a': 'b'}
+        context = Context(envs=envs)
+        context.set_line_value('ENV', {'c': 'd'})
+        assert context.get_values('ENV') == {'a': 'b', 'c': 'd'}
+        assert context.get_line_value('ENV') == {'c': 'd'}
+        assert envs == {'a': 'b'}
 
+    def test_dockerfileparser(self, dfparser):
         dfparser.content = ""
-        dfparser.content = df_content
-        assert dfparser.content == df_content
-        assert dfparser.lines == df_lines
+        dfparser.content = DF_CONTENT
+        assert dfparser.content == DF_CONTENT
+        assert dfparser.lines == DF_LINES
         assert [isinstance(line, str) for line in dfparser.lines]
 
         dfparser.content = ""
-        dfparser.lines = df_lines
-        assert dfparser.content == df_content
-        assert dfparser.lines == df_lines
+        dfparser.lines = DF_LINES
+        assert dfparser.content == DF_CONTENT
+        assert dfparser.lines == DF_LINES
         assert [isinstance(line, str) for line in dfparser.lines]
 
-        dockerfile = os.path.join(str(tmpdir), 'Dockerfile')
-        with open(dockerfile, 'wb') as fp:
-            fp.write(df_content.encode('utf-8'))
-        dfparser = DockerfileParser(dockerfile)
-        assert dfparser.content == df_content
-        assert dfparser.lines == df_lines
+        dfparser = DockerfileParser(fileobj=io.BytesIO(DF_CONTENT.encode('utf-8')))
+        assert dfparser.content == DF_CONTENT
+        assert dfparser.lines == DF_LINES
         assert [isinstance(line, str) for line in dfparser.lines]
 
-    def test_dockerfileparser_exceptions(self, tmpdir):
-        df_content = dedent("""\
-            FROM fedora
-            LABEL label={0}""".format(NON_ASCII))
-        df_lines = ["FROM fedora\n", "LABEL label={0}".format(NON_ASCII)]
+    def test_dockerfileparser_line_endings(self, dfparser):
+        # only newlines end lines, whether or not the content is cached
+        dfparser.content = "FROM fedora\r\nLABEL a=b\x0cc \nRUN true"
+        assert dfparser.lines == ["FROM fedora\r\n", "LABEL a=b\x0cc \n", "RUN true"]
+        assert len(dfparser.structure) == 3
 
-        dfp = DockerfileParser(os.path.join(str(tmpdir), 'no-directory'))
+    def test_dockerfileparser_exceptions(self, tmp_path):
+        dfp = DockerfileParser(str(tmp_path / 'no-directory'))
         with pytest.raises(IOError):
             assert dfp.content
         with pytest.raises(IOError):
-            dfp.content = df_content
+            dfp.content = DF_CONTENT
         with pytest.raises(IOError):
             assert dfp.lines
         with pytest.raises(IOError):
-            dfp.lines = df_lines
+            dfp.lines = DF_LINES
 
-    def test_internal_exceptions(self, tmpdir):
-        dfp = DockerfileParser(str(tmpdir))
+    def test_internal_exceptions(self):
+        dfp = DockerfileParser(fileobj=io.BytesIO())
         with pytest.raises(ValueError):
             dfp._instruction_getter('FOO', env_replace=True)
         with pytest.raises(ValueError):
@@ -118,112 +551,102 @@ class TestDockerfileParser(object):
         with pytest.raises(ValueError):
             dfp._modify_instruction_label_env('FOO', 'key', 'value')
 
-    def test_constructor_cache(self, tmpdir):
-        tmpdir_path = str(tmpdir.realpath())
+    def test_constructor_cache(self, tmp_path):
+        tmpdir_path = str(tmp_path)
         df1 = DockerfileParser(tmpdir_path)
         df1.lines = ["From fedora:latest\n", "LABEL a b\n"]
 
         df2 = DockerfileParser(tmpdir_path, True)
         assert df2.cached_content
 
+        # the path may also point to the Dockerfile itself
+        df3 = DockerfileParser(str(tmp_path / 'Dockerfile'))
+        assert df3.content == df2.cached_content
+
+    def test_cached_content_rewritten(self):
+        fileobj = io.BytesIO()
+        dfp = DockerfileParser(fileobj=fileobj, cache_content=True)
+        dfp.content = "FROM fedora\n"
+        fileobj.write(b"FROM centos\n")
+
+        # the Dockerfile may have changed behind the cache, it is written anyway
+        dfp.content = "FROM fedora\n"
+        assert fileobj.getvalue() == b"FROM fedora\n"
+
+        fileobj.write(b"FROM centos\n")
+        dfp.lines = ["FROM fedora\n"]
+        assert fileobj.getvalue() == b"FROM fedora\n"
+
+    def test_lines_not_shared(self, dfparser):
+        dfparser.content = DF_CONTENT
+        assert dfparser.structure[0]['instruction'] == 'FROM'
+        lines = dfparser.lines
+        lines.append("RUN true\n")
+        assert dfparser.lines == DF_LINES
+        assert dfparser.content == DF_CONTENT
+
+    def test_edit(self, tmp_path):
+        tmpdir_path = str(tmp_path)
+        dfp = DockerfileParser(tmpdir_path)
+        dfp.content = "FROM fedora\n"
+
+        with dfp.edit():
+            dfp.labels = {'a': 'b ❤', 'c': 'd'}
+            with dfp.edit():
+                dfp.add_lines("RUN true")
+            dfp.labels['c'] = 'e'
+            assert dfp.labels == {'a': 'b ❤', 'c': 'e'}
+            assert dfp.lines[-1] == "RUN true\n"
+            # nothing written yet
+            assert DockerfileParser(tmpdir_path).content == "FROM fedora\n"
+
+            dfp.flush()
+            assert DockerfileParser(tmpdir_path).content == dfp.content
+            dfp.content = "FROM centos\nLABEL a=b"
+            assert dfp.lines == ["FROM centos\n", "LABEL a=b"]
+
+        assert DockerfileParser(tmpdir_path).content == "FROM centos\nLABEL a=b"
+
+    def test_edit_exception(self, dfparser):
+        dfparser.content = "FROM fedora\n"
+
+        with pytest.raises(ValueError):
+            with dfparser.edit():
+                dfparser.add_lines("RUN true")
+                raise ValueError("interrupted")
+
+        # the unfinished changes are discarded
+        assert dfparser.content == "FROM fedora\n"
+        dfparser.add_lines("RUN false")
+        assert dfparser.lines == ["FROM fedora\n", "RUN false\n"]
+
+    def test_setter_exception(self, dfparser):
+        dfparser.content = "FROM fedora\nLABEL a=b c=d\n"
+
+        # 'a' is deleted before adding 'e' fails
+        with pytest.raises(TypeError):
+            dfparser.labels = {'c': 'd', 'e': 1}
+
+        # the setter writes all of its changes or none
+        assert dfparser.content == "FROM fedora\nLABEL a=b c=d\n"
+        assert dfparser.labels == {'a': 'b', 'c': 'd'}
+
     def test_dockerfile_structure(self, dfparser):
-        dfparser.lines = ["# comment\n",                # single-line comment
-                          " From  \\\n",                # mixed-case
-                          "   base\n",                  # extra ws, continuation line
-                          " #    another   comment\n",  # extra ws
-                          " label  foo  \\\n",          # extra ws
-                          "# interrupt LABEL\n",        # comment interrupting multi-line LABEL
-                          "    bar  \n",                # extra ws, instruction continuation
-                          "USER  {0}\n".format(NON_ASCII),
-                          "# comment \\\n",             # extra ws
-                          "# with \\ \n",               # extra ws with a space
-                          "# backslashes \\\\ \n",      # two backslashes
-                          "#no space after hash\n",
-                          "# comment # with hash inside\n",
-                          "RUN command1\n",
-                          "RUN command2 && \\\n",
-                          "    command3\n",
-                          "RUN command4 && \\\n",
-                          "# interrupt RUN\n",          # comment interrupting multi-line RUN
-                          "    command5\n",
-                          ]
+        dfparser.lines = DOCKERFILE_STRUCTURE_LINES
+        assert dfparser.structure == DOCKERFILE_STRUCTURE
 
-        assert dfparser.structure == [
-                                      {'instruction': COMMENT_INSTRUCTION,
+    def test_dockerfile_structure_cache(self, dfparser):
+        dfparser.content = "FROM fedora\nCMD xyz\n"
+        structure = dfparser.structure
+        structure[0]['value'] = 'changed'
+        assert dfparser.structure[0]['value'] == 'fedora'
+
+        dfparser.content = "FROM centos\n"
+        assert dfparser.structure == [{'instruction': 'FROM',
                                        'startline': 0,
                                        'endline': 0,
-                                       'content': '# comment\n',
-                                       'value': 'comment'},
-                                      {'instruction': 'FROM',
-                                       'startline': 1,
-                                       'endline': 2,
-                                       'content': ' From  \\\n   base\n',
-                                       'value': 'base'},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 3,
-                                       'endline': 3,
-                                       'content': ' #    another   comment\n',
-                                       'value': 'another   comment'},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 5,
-                                       'endline': 5,
-                                       'content': '# interrupt LABEL\n',
-                                       'value': 'interrupt LABEL'},
-                                      {'instruction': 'LABEL',
-                                       'startline': 4,
-                                       'endline': 6,
-                                       'content': ' label  foo  \\\n    bar  \n',
-                                       'value': 'foo      bar'},
-                                      {'instruction': 'USER',
-                                       'startline': 7,
-                                       'endline': 7,
-                                       'content': 'USER  {0}\n'.format(NON_ASCII),
-                                       'value': '{0}'.format(NON_ASCII)},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 8,
-                                       'endline': 8,
-                                       'content': '# comment \\\n',
-                                       'value': 'comment \\'},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 9,
-                                       'endline': 9,
-                                       'content': '# with \\ \n',
-                                       'value': 'with \\ '},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 10,
-                                       'endline': 10,
-                                       'content': '# backslashes \\\\ \n',
-                                       'value': 'backslashes \\\\ '},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 11,
-                                       'endline': 11,
-                                       'content': '#no space after hash\n',
-                                       'value': 'no space after hash'},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 12,
-                                       'endline': 12,
-                                       'content': '# comment # with hash inside\n',
-                                       'value': 'comment # with hash inside'},
-                                      {'instruction': 'RUN',
-                                       'startline': 13,
-                                       'endline': 13,
-                                       'content': 'RUN command1\n',
-                                       'value': 'command1'},
-                                      {'instruction': 'RUN',
-                                       'startline': 14,
-                                       'endline': 15,
-                                       'content': 'RUN command2 && \\\n    command3\n',
-                                       'value': 'command2 &&     command3'},
-                                      {'instruction': COMMENT_INSTRUCTION,
-                                       'startline': 17,
-                                       'endline': 17,
-                                       'content': '# interrupt RUN\n',
-                                       'value': 'interrupt RUN'},
-                                      {'instruction': 'RUN',
-                                       'startline': 16,
-                                       'endline': 18,
-                                       'content': 'RUN command4 && \\\n    command5\n',
-                                       'value': 'command4 &&     command5'}]
+                                       'content': 'FROM centos\n',
+                                       'value': 'centos'}]
 
     def test_invalid_dockerfile_structure(self, dfparser):
         '''Invalid instruction is reserverd.'''
@@ -248,11 +671,11 @@ class TestDockerfileParser(object):
             # comment
             From  base:❤
             LABEL foo="bar❤baz"
-            USER  {0}""").format(NON_ASCII)
+            """) + USER_LINE_NON_ASCII
         expected = json.dumps([{"COMMENT": "comment"},
                                {"FROM": "base:❤"},
                                {"LABEL": "foo=\"bar❤baz\""},
-                               {"USER": "{0}".format(NON_ASCII)}])
+                               {"USER": NON_ASCII}])
         assert dfparser.json == expected
 
     def test_multistage_dockerfile(self, dfparser):
@@ -321,10 +744,9 @@ class TestDockerfileParser(object):
                           "LABEL a b\n"]
         assert dfparser.baseimage == 'fedora:latest'
 
-    def test_get_baseimg_from_build_arg(self, tmpdir):
-        tmpdir_path = str(tmpdir.realpath())
+    def test_get_baseimg_from_build_arg(self):
         b_args = {"BASE": "fedora:latest"}
-        dfp = DockerfileParser(tmpdir_path, env_replace=True, build_args=b_args)
+        dfp = DockerfileParser(fileobj=io.BytesIO(), env_replace=True, build_args=b_args)
         dfp.lines = ["ARG BASE=centos:latest\n",
                      "FROM $BASE\n",
                      "LABEL a b\n"]
@@ -337,10 +759,9 @@ class TestDockerfileParser(object):
             dfparser.baseimage = 'fedora:latest'
         assert not dfparser.baseimage
 
-    def test_get_build_args(self, tmpdir):
-        tmpdir_path = str(tmpdir.realpath())
+    def test_get_build_args(self):
         b_args = {"bar": "baz❤"}
-        df1 = DockerfileParser(tmpdir_path, env_replace=True, build_args=b_args)
+        df1 = DockerfileParser(fileobj=io.BytesIO(), env_replace=True, build_args=b_args)
         df1.lines = [
             "ARG foo=\"baz❤\"\n",
             "ARG not=\"used\"\n",
@@ -359,10 +780,9 @@ class TestDockerfileParser(object):
         assert len(df1.labels) == 1
         assert df1.labels.get('label') == 'baz❤ baz❤'
 
-    def test_get_build_args_from_scratch(self, tmpdir):
-        tmpdir_path = str(tmpdir.realpath())
+    def test_get_build_args_from_scratch(self):
         b_args = {"bar": "baz"}
-        df1 = DockerfileParser(tmpdir_path, env_replace=True, build_args=b_args)
+        df1 = DockerfileParser(fileobj=io.BytesIO(), env_replace=True, build_args=b_args)
         df1.lines = [
             "FROM scratch\n",
         ]
@@ -371,10 +791,9 @@ class TestDockerfileParser(object):
         assert not (df1.args == ['bar', 'baz'])
         assert hash(df1.args)
 
-    def test_get_parent_env(self, tmpdir):
-        tmpdir_path = str(tmpdir.realpath())
+    def test_get_parent_env(self):
         p_env = {"bar": "baz❤"}
-        df1 = DockerfileParser(tmpdir_path, env_replace=True, parent_env=p_env)
+        df1 = DockerfileParser(fileobj=io.BytesIO(), env_replace=True, parent_env=p_env)
         df1.lines = [
             "FROM parent\n",
             "ENV foo=\"$bar\"\n",
@@ -389,10 +808,9 @@ class TestDockerfileParser(object):
         assert len(df1.labels) == 1
         assert df1.labels.get('label') == 'baz❤ baz❤'
 
-    def test_get_parent_env_from_scratch(self, tmpdir):
-        tmpdir_path = str(tmpdir.realpath())
+    def test_get_parent_env_from_scratch(self):
         p_env = {"bar": "baz"}
-        df1 = DockerfileParser(tmpdir_path, env_replace=True, parent_env=p_env)
+        df1 = DockerfileParser(fileobj=io.BytesIO(), env_replace=True, parent_env=p_env)
         df1.lines = [
             "FROM scratch\n",
         ]
@@ -401,72 +819,22 @@ class TestDockerfileParser(object):
         assert not (df1.envs == ['bar', 'baz'])
         assert hash(df1.envs)
 
-    @pytest.mark.parametrize(('instr_value', 'expected'), [
-        # pylint: disable=anomalous-backslash-in-string
-        ('"name1"=\'value 1\' "name2"=myself name3=""',
-         {'name1': 'value 1',
-          'name2': 'myself',
-          'name3': ''}),
-        ('name5=5', {'name5': '5'}),
-        ('"name6"=6', {'name6': '6'}),
-        ('name7', {'name7': ''}),
-        ('"name8"', {'name8': ''}),
-        ('"name9"="asd \\  \\n qwe"', {'name9': 'asd \\  \\n qwe'}),
-        ('"name10"="{0}"'.format(NON_ASCII), {'name10': NON_ASCII}),
-        ('"name1 1"=1', {'name1 1': '1'}),
-        ('"name12"=12 \\ \n   "name13"=13', {'name12': '12', 'name13': '13'}),
-        ('name14=1\\ 4', {'name14': '1 4'}),
-        ('name15="with = in value"', {'name15': 'with = in value'}),
-        ('name16=❤', {'name16': '❤'}),
-        ('name❤=❤', {'name❤': '❤'}),
-        # old syntax (without =)
-        ('name101 101', {'name101': '101'}),
-        ('name102 1 02', {'name102': '1 02'}),
-        ('"name103" 1 03', {'name103': '1 03'}),
-        ('name104 "1"  04', {'name104': '1  04'}),
-        ('name105 1 \'05\'', {'name105': '1 05'}),
-        ('name106 1 \'0\'   6', {'name106': '1 0   6'}),
-        ('name107 1 0\\ 7', {'name107': '1 0 7'}),
-        ('name108 "with = in value"', {'name108': 'with = in value'}),
-        ('name109 "\\"quoted\\""', {'name109': '"quoted"'}),
-        ('name110 ❤', {'name110': '❤'}),
-        ('name1❤ ❤', {'name1❤': '❤'}),
-    ])
-    def test_get_instructions_from_df(self, dfparser, instruction, instr_value,
+    @pytest.mark.parametrize(('instr_value', 'expected'), INSTRUCTION_VALUE_CASES)
+    def test_get_instructions_from_df(self, dfparser_shared, instruction, instr_value,
                                       expected):
-        dfparser.content = "{0} {1}\n".format(instruction, instr_value)
+        dfparser_shared.content = "{0} {1}\n".format(instruction, instr_value)
         if instruction == 'LABEL':
-            instructions = dfparser.labels
+            instructions = dfparser_shared.labels
         elif instruction == 'ENV':
-            instructions = dfparser.envs
+            instructions = dfparser_shared.envs
         elif instruction == 'ARG':
-            instructions = dfparser.args
+            instructions = dfparser_shared.args
         else:
             assert False, 'Unexpected instruction: {0}'.format(instruction)
 
         assert instructions == expected
 
-    @pytest.mark.parametrize(('from_value', 'expect'), [
-        (
-            "    ",
-            (None, None),
-        ), (
-            "   foo",
-            ('foo', None),
-        ), (
-            "foo:bar as baz   ",
-            ('foo:bar', 'baz'),
-        ), (
-            "foo as baz",
-            ('foo', 'baz'),
-        ), (
-            "foo and some other junk",  # we won't judge
-            ('foo', None),
-        ), (
-            "registry.example.com:5000/foo/bar:baz",
-            ('registry.example.com:5000/foo/bar:baz', None),
-        )
-    ])
+    @pytest.mark.parametrize(('from_value', 'expect'), IMAGE_FROM_CASES)
     def test_image_from(self, from_value, expect):
         result = image_from(from_value)
         assert result == expect
@@ -512,11 +880,7 @@ class TestDockerfileParser(object):
     def test_modify_instruction(self, dfparser):
         FROM = ('ubuntu', 'fedora:❤')
         CMD = ('old❤cmd', 'new❤command')
-        df_content = dedent("""\
-            FROM {0}
-            CMD {1}""").format(FROM[0], CMD[0])
-
-        dfparser.content = df_content
+        dfparser.content = MODIFY_INSTRUCTION_TEMPLATE.format(FROM[0], CMD[0])
 
         assert dfparser.baseimage == FROM[0]
         dfparser.baseimage = FROM[1]
@@ -536,13 +900,8 @@ class TestDockerfileParser(object):
         BUILDER_CMD = '/code/run-extras'
         UPDATED_BASE_CMD = '/code/run-main-actors'
 
-        df_content = dedent("""\
-            ARG  CODE_VERSION={0}
-            FROM {1}
-            CMD {2}
-
-            FROM {3}
-            """).format(CODE_VERSION, BUILDER_FROM, BUILDER_CMD, BASE_FROM)
+        df_content = MODIFY_FROM_MULTISTAGE_TEMPLATE.format(CODE_VERSION, BUILDER_FROM,
+                                                            BUILDER_CMD, BASE_FROM)
 
         INDEX_FIRST_FROM = 1
         INDEX_SECOND_FROM = 4
@@ -572,16 +931,7 @@ class TestDockerfileParser(object):
         assert dfparser.lines[INDEX_SECOND_CMD].strip() == 'CMD {0}'.format(UPDATED_BASE_CMD)
 
     def test_add_del_instruction(self, dfparser):
-        df_content = dedent("""\
-            CMD xyz
-            LABEL a=b c=d
-            LABEL x=\"y z\"
-            ENV h i
-            ENV j='k' l=m
-            ARG a b
-            ARG c='d' e=f
-            """)
-        dfparser.content = df_content
+        dfparser.content = ADD_DEL_INSTRUCTION_CONTENT
 
         dfparser._add_instruction('FROM', 'fedora')
         assert dfparser.baseimage == 'fedora'
@@ -617,55 +967,7 @@ class TestDockerfileParser(object):
 
     @pytest.mark.parametrize(('existing',
                               'delete_key',
-                              'expected'), [
-        # Delete non-existing key
-        (['a b\n',
-          'x="y z"\n'],
-         'name',
-         KeyError()),
-
-        # Simple remove
-        (['a b\n',
-          'x="y z"\n'],
-         'a',
-         ['x="y z"\n']),
-
-        # Simple remove
-        (['a b\n',
-          'x="y z"\n'],
-         'x',
-         ['a b\n']),
-
-        # Simple remove unicode
-        (['a b\n',
-          'x="y ❤"\n'],
-         'x',
-         ['a b\n']),
-
-        # Simple remove unicode
-        (['a b\n',
-          '❤="y z"\n'],
-         '❤',
-         ['a b\n']),
-
-        #  Remove first of two instructions on the same line
-        (['a b\n',
-          'x="y z"\n',
-          '"first"="first" "second"="second"\n'],
-         'first',
-         ['a b\n',
-          'x="y z"\n',
-          '"second"="second"\n']),
-
-        #  Remove second of two instructions on the same line
-        (['a b\n',
-          'x="y z"\n',
-          '"first"="first" "second"="second"\n'],
-         'second',
-         ['a b\n',
-          'x="y z"\n',
-          '"first"="first"\n']),
-    ])
+                              'expected'), DELETE_INSTRUCTION_CASES)
     def test_delete_instruction(self, dfparser, instruction, existing, delete_key, expected):
         existing = [instruction + ' ' + i for i in existing]
         if isinstance(expected, list):
@@ -677,57 +979,11 @@ class TestDockerfileParser(object):
                 dfparser._delete_instructions(instruction, delete_key)
         else:
             dfparser._delete_instructions(instruction, delete_key)
-            assert set(dfparser.lines[1:]) == set(expected)
+            assert sorted(dfparser.lines[1:]) == sorted(expected)
 
     @pytest.mark.parametrize(('existing',
                               'new',
-                              'expected'), [
-        # Simple test: set an instruction
-        (['a b\n',
-          'x="y z"\n'],
-         {'Name': 'New shiny project'},
-         ['Name=\'New shiny project\'\n']),
-
-        # Set two instructions
-        (['a b\n',
-          'x="y z"\n'],
-         {'something': 'nothing', 'mine': 'yours'},
-         ['something=nothing\n', 'mine=yours\n']),
-
-        # Set instructions to what they already were: should be no difference
-        (['a b\n',
-          'x="y z"\n',
-          '"first"="first" second=\'second value\'\n'],
-         {'a': 'b', 'x': 'y z', 'first': 'first', 'second': 'second value'},
-         ['a b\n',
-          'x="y z"\n',
-          '"first"="first" second=\'second value\'\n']),
-
-        # Adjust one label of a multi-value LABEL/ENV statement
-        (['a b\n',
-          'first=\'first value\' "second"=second\n',
-          'x="y z"\n'],
-         {'first': 'changed', 'second': 'second'},
-         ['first=changed "second"=second\n']),
-
-        # Delete one label of a multi-value LABEL/ENV statement
-        (['a b\n',
-          'x="y z"\n',
-          'first=first second=second\n'],
-         {'second': 'second'},
-         ['second=second\n']),
-
-        # Nested quotes
-        (['"ownership"="Alice\'s label" other=value\n'],
-         {'ownership': "Alice's label"},
-         # Keeps existing key quoting style
-         ['"ownership"="Alice\'s label"\n']),
-
-        # Modify a single value that needs quoting
-        (['foo bar\n'],
-         {'foo': 'extra bar'},
-         ["foo 'extra bar'\n"]),
-    ])
+                              'expected'), SETTER_CASES)
     def test_setter(self, dfparser, instruction, existing, new, expected):
         existing = [instruction + ' ' + i for i in existing]
         if isinstance(expected, list):
@@ -743,39 +999,12 @@ class TestDockerfileParser(object):
         elif instruction == 'ARG':
             dfparser.args = new
             assert dfparser.args == new
-        assert set(dfparser.lines[1:]) == set(expected)
-
-    @pytest.mark.parametrize(('old_instructions', 'key', 'new_value', 'expected'), [
-        # Simple case, no '=' or quotes
-        ('Release 1', 'Release', '2', 'Release 2'),
-        # No '=' but quotes (which are kept)
-        ('"Release" "2"', 'Release', '3', '"Release" 3'),
-        # Simple case, '=' but no quotes
-        ('Release=1', 'Release', '6', 'Release=6'),
-        # '=' and quotes, with space in the value
-        ('"Name"=\'alpha alpha\' Version=1',
-         'Name', 'beta delta', '"Name"=\'beta delta\' Version=1'),
-        ('Name=foo', 'Name', 'new value', "Name='new value'"),
-        # ' ' and quotes
-        ('"Name" alpha alpha', 'Name', 'beta delta', "\"Name\" 'beta delta'"),
-        # '=', multiple labels, no quotes
-        ('Name=foo Release=3', 'Release', '4', 'Name=foo Release=4'),
-        # '=', multiple labels and quotes
-        ('Name=\'foo bar\' "Release"="4"', 'Release', '5', 'Name=\'foo bar\' "Release"=5'),
-        # Release that's not entirely numeric
-        ('Version=1.1', 'Version', '2.1', 'Version=2.1'),
-    ])
-    def test_setter_direct(self, dfparser, instruction, old_instructions, key, new_value, expected):
-        df_content = dedent("""\
-            FROM xyz
-            LABEL a b
-            LABEL x=\"y z\"
-            ENV c d
-            ENV e=\"f g\"
-            {0} {1}
-            """).format(instruction, old_instructions)
+        assert sorted(dfparser.lines[1:]) == sorted(expected)
 
-        dfparser.content = df_content
+    @pytest.mark.parametrize(('old_instructions', 'key', 'new_value', 'expected'),
+                             SETTER_DIRECT_CASES)
+    def test_setter_direct(self, dfparser, instruction, old_instructions, key, new_value, expected):
+        dfparser.content = SETTER_DIRECT_TEMPLATE.format(instruction, old_instructions)
         if instruction == 'LABEL':
             dfparser.labels[key] = new_value
             assert dfparser.labels[key] == new_value
@@ -791,77 +1020,38 @@ class TestDockerfileParser(object):
 
     @pytest.mark.parametrize('instruction', ('ARG', 'ENV'))
     @pytest.mark.parametrize('separator', [' ', '='])
-    @pytest.mark.parametrize(('label', 'expected'), [
-        # Expected substitutions
-        ('$V', 'v'),
-        ('"$V"', 'v'),
-        ('$V-foo', 'v-foo'),
-        ('"$V-foo"', 'v-foo'),
-        ('"$V"-foo', 'v-foo'),
-        ('${V}', 'v'),
-        ('${V}-foo', 'v-foo'),
-        ('$V-{foo}', 'v-{foo}'),
-        ('$V-❤', 'v-❤'),
-        ('$VS', 'spam maps'),
-
-        # These should not be substituted, only dequoted
-        ("'$V'", "$V"),
-        ("\\$V", "$V"),
-        ("\\$V❤", "$V❤"),
-
-        # Try to trip up the parser
-        ('\\"$V', '"v'),
-        ("\\'$V", "'v"),
-        ('$V}', 'v}'),
-        ('${}', ''),
-        ("'\\'$V'\\'", "\\v\\"),
-    ])
-    def test_arg_env_replace(self, dfparser, instruction, separator, label, expected):
-        dfparser.lines = ["FROM fedora\n",
-                          "{0} V=v\n".format(instruction),
-                          "{0} VS='spam maps'\n".format(instruction),
-                          "LABEL TEST{0}{1}\n".format(separator, label)]
-        assert dfparser.labels['TEST'] == expected
+    @pytest.mark.parametrize(('label', 'expected'), ARG_ENV_REPLACE_CASES)
+    def test_arg_env_replace(self, dfparser_shared, instruction, separator, label, expected):
+        dfparser_shared.lines = (ARG_ENV_REPLACE_BASE_LINES[instruction] +
+                                 ["LABEL TEST{0}{1}\n".format(separator, label)])
+        assert dfparser_shared.labels['TEST'] == expected
         with pytest.raises(TypeError):
-            dfparser.labels = ['foo', 'bar']
+            dfparser_shared.labels = ['foo', 'bar']
 
     @pytest.mark.parametrize('instruction', ('ARG', 'ENV'))
     @pytest.mark.parametrize('separator', [' ', '='])
-    @pytest.mark.parametrize(('label', 'expected'), [
-        # These would have been substituted with env_replace=True
-        ('$V', '$V'),
-        ('"$V"', '$V'),
-        ('$V-foo', '$V-foo'),
-        ('"$V-foo"', '$V-foo'),
-        ('"$V"-foo', '$V-foo'),
-        ('"$V"-❤', '$V-❤'),
-    ])
-    def test_arg_env_noreplace(self, dfparser, instruction, separator, label, expected):
+    @pytest.mark.parametrize(('label', 'expected'), ARG_ENV_NOREPLACE_CASES)
+    def test_arg_env_noreplace(self, dfparser_shared, instruction, separator, label, expected):
         """
         Make sure environment replacement can be disabled.
         """
-        dfparser.env_replace = False
-        dfparser.lines = ["FROM fedora\n",
-                          "{0} V=v\n".format(instruction),
-                          "LABEL TEST{0}{1}\n".format(separator, label)]
-        assert dfparser.labels['TEST'] == expected
+        dfparser_shared.env_replace = False
+        dfparser_shared.lines = (ARG_ENV_BASE_LINES[instruction] +
+                                 ["LABEL TEST{0}{1}\n".format(separator, label)])
+        assert dfparser_shared.labels['TEST'] == expected
 
     @pytest.mark.parametrize('instruction', ('ARG', 'ENV'))
-    @pytest.mark.parametrize('label', [
-        '${V',
-        '"${V"',
-        '${{{{V}',
-    ])
-    def test_arg_env_invalid(self, dfparser, instruction, label):
+    @pytest.mark.parametrize('label', ARG_ENV_INVALID_LABELS)
+    def test_arg_env_invalid(self, dfparser_shared, instruction, label):
         """
         These tests are invalid, but the parser should at least terminate
         even if it raises an exception.
         """
-        dfparser.lines = ["FROM fedora\n",
-                          "{0} v=v\n".format(instruction),
-                          "LABEL TEST={0}\n".format(label)]
+        dfparser_shared.lines = ["FROM fedora\n",
+                                 "{0} v=v\n".format(instruction),
+                                 "LABEL TEST={0}\n".format(label)]
         try:
-            dfparser.labels['TEST']
+            dfparser_shared.labels['TEST']
         except KeyError:
             pass
 
@@ -898,14 +1088,13 @@ class TestDockerfileParser(object):
         ('${UNDEF:+foo}', 'foo'),
         ('${UNDEF:+${V}}', 'v'),
     ])
-    def test_arg_env_replace_notimplemented(self, dfparser, instruction, label, expected):
+    def test_arg_env_replace_notimplemented(self, dfparser_shared, instruction, label, expected):
         """
         Test for syntax we don't support yet but should.
         """
-        dfparser.lines = ["FROM fedora\n",
-                          "{0} V=v\n".format(instruction),
-                          "LABEL TEST={0}\n".format(label)]
-        assert dfparser.labels['TEST'] == expected
+        dfparser_shared.lines = (ARG_ENV_BASE_LINES[instruction] +
+                                 ["LABEL TEST={0}\n".format(label)])
+        assert dfparser_shared.labels['TEST'] == expected
 
     def test_path_and_fileobj_together(self):
         with pytest.raises(ValueError):
@@ -916,22 +1105,7 @@ class TestDockerfileParser(object):
             DockerfileParser(fileobj=sys.stdin)
 
     def test_context_structure_per_line(self, dfparser, instruction):
-        dfparser.content = dedent("""\
-            FROM fedora:25
-
-            {0} multi.label❤1="value❤1" \\
-                  multi.label❤2="value❤2" \\
-                  other="value❤3"
-
-            {0} 2multi.label1="othervalue1" 2multi.label2="othervalue2" other="othervalue3"
-
-            {0} "com.example.vendor"="ACME Incorporated"
-            {0} com.example.label-with-value="foo"
-            {0} version="1.0.❤"
-            {0} description="This text illustrates ❤ \\
-            that label-values can span multiple lines."
-            {0} key="with = in the value❤"
-            """).format(instruction)
+        dfparser.content = CONTEXT_STRUCTURE_PER_LINE_TEMPLATE.format(instruction)
 
         c = dfparser.context_structure
 
@@ -968,21 +1142,7 @@ class TestDockerfileParser(object):
         }
 
     def test_context_structure(self, dfparser, instruction):
-        dfparser.content = dedent("""\
-            FROM fedora:25
-
-            {0} multi.label❤1="value❤1" \\
-                  multi.label❤2="value❤2" \\
-                  other="value❤3"
-
-            {0} 2multi.label1="othervalue1" 2multi.label2="othervalue2" other="othervalue3"
-
-            {0} "com.example.vendor"="ACME Incorporated"
-            {0} com.example.label-with-value="foo"
-            {0} version="1.0.❤"
-            {0} description="This text illustrates \\
-            that label-values can span multiple lines."
-            """).format(instruction)
+        dfparser.content = CONTEXT_STRUCTURE_TEMPLATE.format(instruction)
 
         c = dfparser.context_structure
 
@@ -1043,12 +1203,7 @@ class TestDockerfileParser(object):
         }
 
     def test_context_structure_mixed(self, dfparser, instruction):
-        dfparser.content = dedent("""\
-            FROM fedora:25
-
-            {0} key=value❤
-            RUN touch /tmp/a
-            {0} key2=value2❤""").format(instruction)
+        dfparser.content = CONTEXT_STRUCTURE_MIXED_TEMPLATE.format(instruction)
 
         c = dfparser.context_structure
         assert c[0].get_values(context_type=instruction) == {}
@@ -1059,12 +1214,7 @@ class TestDockerfileParser(object):
 
     @pytest.mark.parametrize('instruction', ('ARG', 'ENV'))
     def test_context_structure_mixed_arg_env_label(self, dfparser, instruction):
-        dfparser.content = dedent("""\
-            FROM fedora:25
-
-            {0} key=value❤
-            RUN touch /tmp/a
-            LABEL key2=value2❤""".format(instruction))
+        dfparser.content = CONTEXT_STRUCTURE_MIXED_LABEL_TEMPLATE.format(instruction)
         c = dfparser.context_structure
 
         assert c[0].get_values(context_type=instruction) == {}
@@ -1079,9 +1229,9 @@ class TestDockerfileParser(object):
         assert c[3].get_values(context_type=instruction) == {"key": "value❤"}
         assert c[3].get_values(context_type="LABEL") == {"key2": "value2❤"}
 
-    def test_context_structure_mixed_top_arg(self, tmpdir):
+    def test_context_structure_mixed_top_arg(self):
         dfp = DockerfileParser(
-            str(tmpdir.realpath()),
+            fileobj=io.BytesIO(),
             build_args={"version": "8", "key": "value❤"},
             env_replace=True)
         dfp.content = dedent("""\
@@ -1100,6 +1250,51 @@ class TestDockerfileParser(object):
         assert c[3].get_values(context_type='ARG') == {"image": "centos"}
         assert c[4].get_values(context_type='ARG') == {"image": "centos", "key": "value❤"}
 
+    def test_context_structure_cache(self, dfparser):
+        dfparser.content = dedent("""\
+            ARG image=centos
+            FROM $image
+            ARG image
+            ENV key=$image
+            """)
+        c = dfparser.context_structure
+        assert c[3].get_values(context_type='ENV') == {"key": "centos"}
+
+        # the returned contexts are the caller's own
+        c[2].get_values(context_type='ENV')['injected'] = 'y'
+        assert c[3].get_values(context_type='ENV') == {"key": "centos"}
+        assert dfparser.context_structure[2].get_values(context_type='ENV') == {}
+
+        dfparser.build_args = {"image": "fedora"}
+        c = dfparser.context_structure
+        assert c[0].get_values(context_type='ARG') == {"image": "fedora"}
+        assert c[3].get_values(context_type='ENV') == {"key": "fedora"}
+
+        dfparser.env_replace = False
+        assert dfparser.context_structure[3].get_values(context_type='ENV') == {"key": "$image"}
+
+        dfparser.content = "FROM scratch\n"
+        assert len(dfparser.context_structure) == 1
+
+    def test_instruction_getter_cache(self, dfparser):
+        dfparser.content = dedent("""\
+            FROM fedora
+            ARG version
+            LABEL version=$version
+            """)
+        dfparser.env_replace = False
+        labels = dfparser.labels
+        labels['name'] = 'value'
+        assert dfparser.labels == {'version': '$version', 'name': 'value'}
+
+        dfparser.build_args = {'version': '1.0'}
+        dfparser.env_replace = True
+        assert dfparser.labels == {'version': '1.0', 'name': 'value'}
+
+        dfparser.env_replace = False
+        assert dfparser.labels == {'version': '$version', 'name': 'value'}
+        assert dfparser.args == {'version': '1.0'}
+
     def test_expand_concatenated_variables(self, dfparser):
         dfparser.content = dedent("""\
             FROM scratch
@@ -1138,11 +1333,8 @@ class TestDockerfileParser(object):
         else:
             env_line = ''
 
-        dfparser.lines = [
-            "FROM scratch\n",
-            env_line,   # has to appear before the LABEL line
-            "LABEL {0}\n".format(label_value),
-        ]
+        # the ENV line has to appear before the LABEL line
+        dfparser.content = "FROM scratch\n{0}LABEL {1}\n".format(env_line, label_value)
         with pytest.raises(ValueError) as exc_info:
             if action == 'get':
                 dfparser.labels  # pylint: disable=pointless-statement
@@ -1169,19 +1361,7 @@ class TestDockerfileParser(object):
 
     @pytest.mark.parametrize('at_start', [True, False])
     def test_add_lines_stages_skip_scratch(self, dfparser, at_start):
-        dfparser.content = dedent("""\
-            From builder
-            CMD xyz ❤
-            From scratch
-            LABEL type=scratch
-            From base
-            LABEL a=b c=d
-            ENV h i
-            From scratch
-            LABEL type=scratch2
-            From scratch as foo
-            LABEL type=scratch3
-            """)
+        dfparser.content = ADD_LINES_SCRATCH_STAGES_CONTENT
         dfparser.add_lines("something new ❤", all_stages=True, skip_scratch=True, at_start=at_start)
 
         if at_start:
@@ -1200,51 +1380,19 @@ class TestDockerfileParser(object):
         assert "begin with new ❤" in dfparser.lines[0]
         assert "end with new ❤" in dfparser.lines[2]
 
-    @pytest.mark.parametrize(('anchor', 'raises'), [
-        (
-            3, None
-        ),
-        (
-            'CMD xyz ❤\n', None
-        ),
-        (
-            dict(
-                content='CMD xyz ❤\n',
-                startline=3,
-                endline=3,
-                instruction='CMD',
-                value='xyz ❤'
-            ),
-            None
-        ),
-        (
-            -2, AssertionError
-        ),
-        (
-            20, AssertionError
-        ),
-        (
-            2.0, RuntimeError
-        ),
-        (
-            'not there', RuntimeError
-        ),
-        (
-            dict(), AssertionError
+    @pytest.mark.parametrize('anchor', [
+        3,
+        'CMD xyz ❤\n',
+        dict(
+            content='CMD xyz ❤\n',
+            startline=3,
+            endline=3,
+            instruction='CMD',
+            value='xyz ❤'
         ),
     ])
-    def test_add_lines_at(self, dfparser, anchor, raises):
-        dfparser.content = dedent("""\
-            From builder
-            CMD xyz ❤
-            LABEL a=b c=d
-            CMD xyz ❤
-            """)
-
-        if raises:
-            with pytest.raises(raises):
-                dfparser.add_lines_at(anchor, "# something new ❤")
-            return
+    def test_add_lines_at(self, dfparser, anchor):
+        dfparser.content = ADD_LINES_AT_CONTENT
 
         dfparser.add_lines_at(anchor, "# something new ❤")
         assert "something new ❤" in dfparser.content
@@ -1252,6 +1400,19 @@ class TestDockerfileParser(object):
         assert "something new ❤" in dfparser.lines[3]
         assert "CMD" in dfparser.lines[4]
 
+    @pytest.mark.parametrize(('anchor', 'raises'), [
+        (-2, AssertionError),
+        (20, AssertionError),
+        (2.0, RuntimeError),
+        ('not there', RuntimeError),
+        (dict(), AssertionError),
+    ])
+    def test_add_lines_at_raises(self, dfparser, anchor, raises):
+        dfparser.content = ADD_LINES_AT_CONTENT
+
+        with pytest.raises(raises):
+            dfparser.add_lines_at(anchor, "# something new ❤")
+
     @pytest.mark.parametrize('anchor', [
         1,
         'CMD xyz ❤\n',
@@ -1308,11 +1469,7 @@ class TestDockerfileParser(object):
         assert "something new ❤" in dfparser.lines[3]
 
     def test_add_lines_after_continuation(self, dfparser):
-        dfparser.content = dedent("""\
-            FROM builder
-            RUN touch foo ❤; \\
-                touch bar
-            """)
+        dfparser.content = ADD_LINES_AFTER_CONTINUATION_CONTENT
 
         fromline = dfparser.structure[1]
         assert fromline['instruction'] == 'RUN'
@@ -1325,11 +1482,7 @@ class TestDockerfileParser(object):
         ]
 
     def test_replace_lines_continuation(self, dfparser):
-        dfparser.content = dedent("""\
-            FROM builder
-            RUN touch foo; \\
-                touch bar ❤
-            """)
+        dfparser.content = REPLACE_LINES_CONTINUATION_CONTENT
 
         fromline = dfparser.structure[1]
         assert fromline['instruction'] == 'RUN'
@@ -1339,18 +1492,16 @@ class TestDockerfileParser(object):
             "# ❤ something new\n",
         ]
 
-    def test_remove_whitespace(self, tmpdir):
+    def test_remove_whitespace(self):
         """
         Verify keys are parsed correctly even if there is no final newline.
 
         """
-        with open(os.path.join(str(tmpdir), 'Dockerfile'), 'w') as fp:
-            fp.write('FROM scratch')
-        tmpdir_path = str(tmpdir.realpath())
-        df1 = DockerfileParser(tmpdir_path)
+        fileobj = io.BytesIO(b'FROM scratch')
+        df1 = DockerfileParser(fileobj=fileobj)
         df1.labels['foo'] = 'bar ❤'
 
-        df2 = DockerfileParser(tmpdir_path, True)
+        df2 = DockerfileParser(fileobj=fileobj, cache_content=True)
         assert df2.baseimage == 'scratch'
         assert df2.labels['foo'] == 'bar ❤'
 